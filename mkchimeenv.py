@@ -1,12 +1,24 @@
 """Install and manage CHIME pipeline environments."""
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
+import json
+import math
+import os
 from pathlib import Path
+import shutil
+import subprocess
 import sys
 import tempfile
-import toml
-from typing import Optional, Tuple, List
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple, List
 import venv
 
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
 
 import click
 import git
@@ -15,9 +27,15 @@ from rich.progress import Progress
 from rich.console import Console
 
 from packaging.requirements import Requirement, InvalidRequirement
+from packaging.specifiers import SpecifierSet
+from packaging.version import InvalidVersion, Version
 
-from virtualenvapi.manage import VirtualEnvironment
-
+# pygit2 is optional. If it is available it is used to make shallow clones directly
+# with libgit2, rather than starting a git process for each one
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
 
 __version__ = "2024.08"
 
@@ -61,6 +79,9 @@ private_repositories = {
     "chimedb-config": (_clone_path("chime-experiment/chimedb_config", ssh=True), None),
 }
 
+# Only upgrade pip in the new environment if it is older than this
+MIN_PIP_VERSION = Version("23.0")
+
 # At the moment this script struggles to determine extra requirements and so I just list
 # them by hand here
 extra_packages = [
@@ -72,6 +93,20 @@ extra_packages = [
 ]
 
 
+# The minimum time in seconds between updates to a clone's progress bars. Progress is
+# reported far more often than it can be usefully displayed, and every update has to
+# take the lock shared by all the clones
+PROGRESS_INTERVAL = 0.1
+
+# Descriptions of the GitPython operations we show progress for
+_OPCODE_MESSAGES = {
+    git.RemoteProgress.COUNTING: "Counting (remote)",
+    git.RemoteProgress.COMPRESSING: "Compressing (remote)",
+    git.RemoteProgress.RECEIVING: "Receiving",
+    git.RemoteProgress.RESOLVING: "Resolving",
+}
+
+
 def match_opcode(opcode: int) -> Tuple[int, str, bool]:
     """Match GitPython opcode to a description of the operation.
 
@@ -91,29 +126,34 @@ def match_opcode(opcode: int) -> Tuple[int, str, bool]:
         Has the operation just finished.
     """
 
-    codes = (
-        (git.RemoteProgress.COUNTING, "Counting (remote)"),
-        (git.RemoteProgress.COMPRESSING, "Compressing (remote)"),
-        (git.RemoteProgress.RECEIVING, "Receiving"),
-        (git.RemoteProgress.RESOLVING, "Resolving"),
-    )
-
     done = (opcode & git.RemoteProgress.END) != 0
 
-    for code, msg in codes:
-        if opcode & code != 0:
-            return (code, msg, done)
+    # Only one operation is given in each opcode, so strip the stage flags and look up
+    # the description
+    code = opcode & git.RemoteProgress.OP_MASK
+
+    if code in _OPCODE_MESSAGES:
+        return (code, _OPCODE_MESSAGES[code], done)
     else:
         return (0, "Unknown", done)
 
 
-def find_requirements(path: str) -> List[Requirement]:
+@functools.lru_cache(maxsize=None)
+def _canonical_name(name: str) -> str:
+    """A cached version of `packaging.utils.canonicalize_name`."""
+    return canonicalize_name(name)
+
+
+def find_requirements(path: str, build: bool = False) -> List[Requirement]:
     """Read and structure dependencies in a pyproject.toml file.
 
     Parameters
     ----------
     path
         Project path
+    build
+        If set, return the requirements for building the project (from the
+        `build-system` table), rather than its runtime dependencies.
 
     Returns
     -------
@@ -128,9 +168,13 @@ def find_requirements(path: str) -> List[Requirement]:
     if not file.is_file():
         raise FileNotFoundError(f"Project file {file} not found.")
 
-    data = toml.load(file)
-    project = data.get("project", {})
-    dependencies = project.get("dependencies", {}).copy()
+    with file.open("rb") as fh:
+        data = tomllib.load(fh)
+    if build:
+        dependencies = data.get("build-system", {}).get("requires", []).copy()
+    else:
+        project = data.get("project", {})
+        dependencies = project.get("dependencies", {}).copy()
 
     for item in dependencies:
         try:
@@ -158,34 +202,525 @@ class RichProgress(git.RemoteProgress):
         The Progress instance to add the meters too.
     """
 
+    # Several clones may report progress into the same Progress instance at once, so
+    # serialise access to it across all instances
+    _lock = threading.Lock()
+
     def __init__(self, label: str, progress: Progress):
         super().__init__()
 
         self.progress = progress
-        self.overall_task = progress.add_task(f"{label}", total=4)
+        with self._lock:
+            self.overall_task = progress.add_task(f"{label}", total=4)
 
         self.tasks: dict[int, int] = {}
+        self._last_update: dict[int, float] = {}
 
     def update(self, op_code, cur_count, max_count=None, message=""):
         code, msg, done = match_opcode(op_code)
 
-        if code not in self.tasks:
-            self.tasks[code] = self.progress.add_task(msg, total=max_count)
+        # Drop updates that arrive too soon after the last one, apart from those
+        # finishing an operation
+        now = time.monotonic()
+        if (
+            not done
+            and now - self._last_update.get(code, -math.inf) < PROGRESS_INTERVAL
+        ):
+            return
+        self._last_update[code] = now
+
+        with self._lock:
+            if code not in self.tasks:
+                self.tasks[code] = self.progress.add_task(msg, total=max_count)
+
+            task = self.tasks[code]
+            self.progress.update(task, completed=cur_count, visible=(not done))
+
+            if done:
+                self.progress.advance(self.overall_task)
+
+    def finish(self):
+        """Mark the whole operation as complete.
+
+        Not every stage is reported when there is little or nothing to transfer, so
+        this is needed to leave the bars in a finished state.
+        """
+        with self._lock:
+            for task in self.tasks.values():
+                self.progress.update(task, visible=False)
+            self.progress.update(self.overall_task, completed=4)
+
+
+if pygit2 is not None:
+
+    class RichGitCallbacks(pygit2.RemoteCallbacks):
+        """Show the progress of a pygit2 clone with rich.
+
+        This mirrors `RichProgress`, showing an overall bar for the stage of the clone
+        and a second bar for the progress of that stage.
+
+        Parameters
+        ----------
+        label
+            A string label to use on the progress bar.
+        progress
+            The Progress instance to add the meters too.
+        """
+
+        def __init__(self, label: str, progress: Progress):
+            super().__init__()
+
+            self.label = label
+            self.progress = progress
+            self.tasks: dict[str, int] = {}
+            self.overall_task: Optional[int] = None
+            self.finished: set[str] = set()
+            self._last_update = -math.inf
+            self._tried_credentials = False
+
+        def credentials(self, url, username_from_url, allowed_types):
+            # Authenticate ssh clones with the ssh agent. libgit2 asks again if the
+            # credentials are rejected, so only offer them once to avoid looping
+            if self._tried_credentials or not (
+                allowed_types & pygit2.enums.CredentialType.SSH_KEY
+            ):
+                raise pygit2.GitError(f"Could not authenticate to {url}")
+
+            self._tried_credentials = True
+            return pygit2.KeypairFromAgent(username_from_url)
+
+        def transfer_progress(self, stats):
+            # Drop updates that arrive too soon after the last one, apart from those
+            # that finish a stage. libgit2 only counts the deltas once all the objects
+            # have been received, so both stages need checking for being complete
+            now = time.monotonic()
+            received = (
+                stats.total_objects > 0
+                and stats.received_objects == stats.total_objects
+            )
+            resolved = (
+                received
+                and stats.total_deltas > 0
+                and stats.indexed_deltas == stats.total_deltas
+            )
+            at_boundary = (received and "Receiving" not in self.finished) or (
+                resolved and "Resolving" not in self.finished
+            )
+            if not at_boundary and now - self._last_update < PROGRESS_INTERVAL:
+                return
+            self._last_update = now
+
+            # Objects are received first, and then the deltas between them resolved
+            stages = [
+                ("Receiving", stats.received_objects, stats.total_objects, received),
+                ("Resolving", stats.indexed_deltas, stats.total_deltas, resolved),
+            ]
+
+            with RichProgress._lock:
+                if self.overall_task is None:
+                    self.overall_task = self.progress.add_task(self.label, total=2)
+
+                for stage, count, total, done in stages:
+                    if stage in self.finished:
+                        continue
+
+                    if stage not in self.tasks:
+                        self.tasks[stage] = self.progress.add_task(stage, total=total)
+
+                    self.progress.update(
+                        self.tasks[stage],
+                        completed=count,
+                        total=total,
+                        visible=(not done),
+                    )
+
+                    if done:
+                        self.finished.add(stage)
+                        self.progress.advance(self.overall_task)
+                        continue
+
+                    break
+
+        def finish(self):
+            """Mark the whole clone as complete.
+
+            If there are no deltas to resolve that stage is never reported as done, so
+            this is needed to leave the bars in a finished state.
+            """
+            with RichProgress._lock:
+                for task in self.tasks.values():
+                    self.progress.update(task, visible=False)
+                if self.overall_task is not None:
+                    self.progress.update(self.overall_task, completed=2)
+
+        def remove(self):
+            """Remove all the bars, e.g. if the clone failed and will be retried."""
+            with RichProgress._lock:
+                for task in self.tasks.values():
+                    self.progress.remove_task(task)
+                if self.overall_task is not None:
+                    self.progress.remove_task(self.overall_task)
+                self.tasks = {}
+                self.overall_task = None
+
+
+def clone_repository(
+    url: str,
+    path: Path,
+    branch: Optional[str],
+    shallow: bool,
+    label: str,
+    progress: Progress,
+) -> str:
+    """Clone a repository, showing the progress of the clone.
+
+    Shallow clones are made with pygit2 if it is installed, falling back to GitPython
+    otherwise. libgit2 can't make partial clones, so those always use GitPython.
+
+    Parameters
+    ----------
+    url
+        The URL to clone from.
+    path
+        The directory to clone into.
+    branch
+        The branch to check out. If `None` use the default branch.
+    shallow
+        Only clone the latest commit. Otherwise make a partial clone, which gets the
+        full history but only downloads the contents of old files when they are
+        actually needed.
+    label
+        A label for the progress bar.
+    progress
+        The Progress instance to show the clone's progress in.
+
+    Returns
+    -------
+    sha
+        The hash of the commit checked out.
+    """
+    if shallow and pygit2 is not None:
+        callbacks = RichGitCallbacks(label, progress)
+        try:
+            repo = pygit2.clone_repository(
+                url, str(path), checkout_branch=branch, callbacks=callbacks, depth=1
+            )
+            callbacks.finish()
+            return str(repo.head.target)
+        except pygit2.GitError:
+            # libgit2 may not support every URL or authentication method that git
+            # does, so try again with git itself
+            callbacks.remove()
+            shutil.rmtree(path, ignore_errors=True)
+
+    if shallow:
+        clone_options = ["--depth", "1", "--single-branch"]
+    else:
+        clone_options = ["--filter=blob:none"]
+
+    rich_progress = RichProgress(label, progress)
+    repo = git.Repo.clone_from(
+        url,
+        branch=branch,
+        to_path=path,
+        multi_options=clone_options,
+        progress=rich_progress,
+    )
+    rich_progress.finish()
+
+    return repo.head.commit.hexsha
+
+
+def pull_repository(path: Path, label: str, progress: Progress) -> Tuple[str, str]:
+    """Fast-forward a repository to the latest commit on its upstream branch.
+
+    Parameters
+    ----------
+    path
+        The path to the checked out repository.
+    label
+        A label for the progress bar.
+    progress
+        The Progress instance to show the progress of the fetch in.
+
+    Returns
+    -------
+    old_sha, new_sha
+        The hashes of the commit checked out before and after the update.
+    """
+    repo = git.Repo(path)
+    old_sha = repo.head.commit.hexsha
+
+    rich_progress = RichProgress(label, progress)
+    repo.remotes.origin.pull(ff_only=True, progress=rich_progress)
+    rich_progress.finish()
+
+    return old_sha, repo.head.commit.hexsha
+
+
+# Print the versions of all distributions visible to an interpreter as JSON. Where a
+# package is installed more than once the first found is the one that gets imported.
+_INSTALLED_VERSIONS_SCRIPT = """
+import importlib.metadata, json
+versions = {}
+for dist in importlib.metadata.distributions():
+    name = dist.metadata["Name"]
+    if name:
+        versions.setdefault(name, dist.version)
+print(json.dumps(versions))
+"""
+
+
+class PipEnvironment:
+    """Run pip and python commands within a virtual environment.
+
+    This calls the environment's interpreter directly, and keeps a log of the output of
+    each command in `build.log` and `build.err` in the environment directory.
+
+    Parameters
+    ----------
+    path
+        Path to the virtual environment.
+    uv
+        If set, the path to a `uv` executable. This is used in place of pip to install
+        packages, as it resolves and downloads in parallel.
+        Other pip commands (e.g. `pip wheel`) still use pip.
+    """
+
+    def __init__(self, path: Path, uv: Optional[str] = None):
+        self.path = Path(path)
+        self.uv = uv
+
+        if sys.platform == "win32":
+            self.python_path = self.path / "Scripts" / "python.exe"
+        else:
+            self.python_path = self.path / "bin" / "python"
+
+        self._pip = [str(self.python_path), "-m", "pip", "--disable-pip-version-check"]
+
+        # Remove environment variables that will break pip in virtualenvs
+        # See https://github.com/pypa/virtualenv/issues/845
+        self.env = os.environ.copy()
+        self.env.pop("__PYVENV_LAUNCHER__", None)
+
+        # If set, the directory to keep the pip and uv caches in (in `pip` and `uv`
+        # subdirectories, as their formats differ). Otherwise they use their defaults
+        self.cache_dir: Optional[Path] = None
+
+        self._installed: Optional[Dict[str, str]] = None
+
+    def _execute(self, args: List[str], input: Optional[str] = None) -> str:
+        """Run a command in the environment and return its output."""
+        proc = subprocess.run(
+            args,
+            cwd=self.path,
+            env=self.env,
+            input=input,
+            capture_output=True,
+            text=True,
+        )
+
+        with open(self.path / "build.log", "a") as fh:
+            fh.write(proc.stdout)
+        with open(self.path / "build.err", "a") as fh:
+            fh.write(proc.stderr)
+
+        proc.check_returncode()
+
+        return proc.stdout
+
+    def python(self, args: List[str]) -> str:
+        """Run the environment's python interpreter with the given arguments."""
+        return self._execute([str(self.python_path), *args])
+
+    def pip(self, args: List[str], input: Optional[str] = None) -> str:
+        """Run pip within the environment with the given arguments.
+
+        If given, `input` is sent to pip's stdin.
+        """
+        cache_args = []
+        if self.cache_dir is not None:
+            cache_args = ["--cache-dir", str(self.cache_dir / "pip")]
+        return self._execute([*self._pip, *cache_args, *args], input=input)
+
+    def _uv_pip(self, args: List[str], input: Optional[str] = None) -> str:
+        """Run `uv pip` targeting the environment with the given arguments."""
+        command, *args = args
+        uv_args = [command, "--python", str(self.python_path)]
+        if self.cache_dir is not None:
+            uv_args += ["--cache-dir", str(self.cache_dir / "uv")]
+        return self._execute([self.uv, "pip", *uv_args, *args], input=input)
+
+    def install(
+        self,
+        args: List[str],
+        options: Optional[List[str]] = None,
+        input: Optional[str] = None,
+    ):
+        """Run `pip install` with the given arguments and options.
+
+        This uses `uv pip install` if a `uv` executable was given.
+        """
+        self._installed = None
+        run = self.pip if self.uv is None else self._uv_pip
+        run(["install", *args, *(options or [])], input=input)
+
+    def compile(self, requirements: str, output: Path):
+        """Resolve a set of requirements into a pinned requirements file.
+
+        This needs uv, and uses `uv pip compile` to resolve for the environment's
+        interpreter. Any versions already pinned in `output` are preferred where they
+        satisfy the requirements.
+
+        Parameters
+        ----------
+        requirements
+            The contents of a requirements file to resolve.
+        output
+            Where to write the pinned requirements.
+        """
+        if self.uv is None:
+            raise RuntimeError("Compiling requirements needs uv.")
+        self._uv_pip(["compile", "-", "-o", str(output)], input=requirements)
+
+    def upgrade(self, package: str):
+        """Upgrade a package to its latest version."""
+        self.install([package], options=["--upgrade"])
+
+    def pip_version(self) -> Version:
+        """The version of pip installed in the environment."""
+        # The output looks like "pip X.Y.Z from <path> (python A.B)"
+        return Version(self.pip(["--version"]).split()[1])
+
+    def installed_versions(self) -> Dict[str, str]:
+        """The versions of the installed packages, keyed by canonical name.
+
+        This is cached until the next install.
+        """
+        if self._installed is None:
+            # Ask the environment's interpreter directly, which is much quicker than
+            # starting pip
+            output = self.python(["-c", _INSTALLED_VERSIONS_SCRIPT])
+            self._installed = {
+                _canonical_name(name): version
+                for name, version in json.loads(output).items()
+            }
+        return self._installed
+
+
+def find_uv() -> Optional[str]:
+    """Find a `uv` executable, either on the PATH or from the `uv` python package."""
+    uv = shutil.which("uv")
+
+    if uv is None:
+        try:
+            from uv import find_uv_bin
+
+            uv = find_uv_bin()
+        except (ImportError, FileNotFoundError):
+            pass
+
+    return uv
+
+
+def user_cache_dir() -> Path:
+    """The directory to cache data in, following the XDG base directory spec."""
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "mkchimeenv"
+
+
+def use_cache_dir(env: PipEnvironment, cache_dir: Optional[Path]) -> Path:
+    """Set up the caches for an environment.
+
+    pip and uv share their default caches between all environments, so they are only
+    moved if `cache_dir` is given.
+
+    Parameters
+    ----------
+    env
+        The environment to set the caches of.
+    cache_dir
+        The directory to keep the caches in, if given.
+
+    Returns
+    -------
+    cache_base
+        The directory to keep any other cached data in. This is `cache_dir` if given,
+        and otherwise the user cache directory.
+    """
+    if cache_dir is None:
+        return user_cache_dir()
+
+    env.cache_dir = cache_dir
+    return cache_dir
+
+
+def cached_requirements(
+    name: str, path: Path, sha: str, refresh: bool = False
+) -> Tuple[List[Requirement], List[Requirement]]:
+    """Get the runtime and build requirements of a repository, using a cache.
 
-        task = self.tasks[code]
-        self.progress.update(task, completed=cur_count, visible=(not done))
+    The requirements are fixed for a given commit, so they are cached in the user cache
+    directory keyed by the repository name and commit hash.
 
-        if done:
-            self.progress.advance(self.overall_task)
+    Parameters
+    ----------
+    name
+        Name of the repository.
+    path
+        Path to the checked out repository.
+    sha
+        The hash of the checked out commit.
+    refresh
+        Ignore any cached requirements, and parse them again from the repository.
+
+    Returns
+    -------
+    requirements
+        The runtime requirements, as returned by `find_requirements`.
+    build_requirements
+        The build requirements.
+    """
+    cache_file = user_cache_dir() / "requirements" / f"{name}-{sha}.json"
+
+    if not refresh:
+        try:
+            with cache_file.open() as fh:
+                data = json.load(fh)
+            return (
+                [Requirement(req) for req in data["dependencies"]],
+                [Requirement(req) for req in data["build"]],
+            )
+        except (OSError, ValueError, KeyError, InvalidRequirement):
+            pass
+
+    requirements = find_requirements(path)
+    build_requirements = find_requirements(path, build=True)
+
+    data = {
+        "dependencies": [str(req) for req in requirements],
+        "build": [str(req) for req in build_requirements],
+    }
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with cache_file.open("w") as fh:
+        json.dump(data, fh)
 
+    return requirements, build_requirements
 
-def labeller(enumerable):
-    """For each item in an iterable, also return a string label giving the position."""
 
-    total = len(enumerable)
+def labeller(enumerable, total: Optional[int] = None):
+    """For each item in an iterable, also return a string label giving the position.
+
+    If `total` is not given, it is taken to be the length of the iterable.
+    """
+
+    if total is None:
+        total = len(enumerable)
+
+    width = len(str(total))
 
     for ii, item in enumerate(enumerable):
-        label = f"[{ii + 1:{len(str(total))}d}/{total:d}]"
+        label = f"[{ii + 1:{width}d}/{total:d}]"
         yield label, item
 
 
@@ -195,19 +730,416 @@ def cli():
     pass
 
 
+def _may_be_satisfiable(specifier: SpecifierSet) -> bool:
+    """Check whether a set of version specifiers could possibly be satisfied.
+
+    We can't tell in general without knowing what versions exist, but any exact pins
+    must satisfy all of the specifiers, and no lower bound can be above an upper
+    bound. Anything else is left to pip to discover.
+    """
+    # Each bound is the version and whether the bound itself is allowed
+    lower: Optional[Tuple[Version, bool]] = None
+    upper: Optional[Tuple[Version, bool]] = None
+
+    for spec in specifier:
+        if spec.version.endswith(".*"):
+            continue
+        if spec.operator == "===":
+            if not specifier.contains(spec.version, prereleases=True):
+                return False
+            continue
+        try:
+            version = Version(spec.version)
+        except InvalidVersion:
+            continue
+
+        if spec.operator == "==":
+            if not specifier.contains(version, prereleases=True):
+                return False
+        elif spec.operator in (">=", ">", "~="):
+            bound = (version, spec.operator != ">")
+            # At the same version an exclusive bound is the tighter one
+            if lower is None or (bound[0], not bound[1]) > (lower[0], not lower[1]):
+                lower = bound
+        elif spec.operator in ("<=", "<"):
+            bound = (version, spec.operator == "<=")
+            if upper is None or bound < upper:
+                upper = bound
+
+    if lower is not None and upper is not None:
+        if lower[0] > upper[0]:
+            return False
+        if lower[0] == upper[0] and not (lower[1] and upper[1]):
+            return False
+
+    return True
+
+
+def merge_requirements(name: str, requirements: List[Requirement]) -> List[str]:
+    """Combine several requirements on the same package into one.
+
+    The version specifiers are intersected and the extras combined, so pip has a single
+    requirement per package to resolve. Requirements with environment markers or URLs
+    can't be safely merged, so if any are present the requirements are returned as they
+    are.
+
+    Parameters
+    ----------
+    name
+        The canonical name of the package.
+    requirements
+        The requirements on the package.
+
+    Returns
+    -------
+    requirements
+        The unique requirement strings. This is a single item if they could be merged.
+
+    Raises
+    ------
+    ValueError
+        If the requirements can't all be satisfied. Only exact pins and contradictory
+        bounds are detected, see `_may_be_satisfiable`.
+    """
+    if any(req.marker is not None or req.url is not None for req in requirements):
+        return sorted({str(req) for req in requirements})
+
+    specifier = SpecifierSet()
+    extras = set()
+    for req in requirements:
+        specifier &= req.specifier
+        extras |= req.extras
+
+    if not _may_be_satisfiable(specifier):
+        reqs = ", ".join(sorted(str(req) for req in requirements))
+        raise ValueError(f"Conflicting requirements on {name}: {reqs}")
+
+    extras_str = f"[{','.join(sorted(extras))}]" if extras else ""
+
+    return [f"{name}{extras_str}{specifier}"]
+
+
+def group_requirements(requirements: Iterable[Requirement]) -> Dict[str, List[str]]:
+    """Group requirements together by their canonical package name.
+
+    Parameters
+    ----------
+    requirements
+        The requirements to group.
+
+    Returns
+    -------
+    groups
+        The requirement strings for each package, keyed by canonical name. Where
+        possible the requirements on each package are merged into one.
+
+    Raises
+    ------
+    ValueError
+        If the requirements on a package are in conflict.
+    """
+    groups = {}
+    for req in requirements:
+        groups.setdefault(_canonical_name(req.name), []).append(req)
+
+    return {name: merge_requirements(name, reqs) for name, reqs in groups.items()}
+
+
+def download_multiple(
+    env: PipEnvironment, packages: Dict[str, List[str]], dest: Path
+) -> Set[Path]:
+    """Download multiple packages into a directory concurrently.
+
+    pip only downloads one file at a time, so this runs a separate `pip download` for
+    each package name in a thread pool. Dependencies are not followed. This is only
+    intended to prefetch packages for a following install, so failures are ignored and
+    left for the install to report.
+
+    Returns
+    -------
+    files
+        The files in `dest` for the packages, whether they were downloaded now or
+        were already there.
+    """
+
+    # Each download gets all the requirements on the same package, so two downloads
+    # don't try to write the same file
+    def _download(reqs):
+        try:
+            output = env.pip(["download", "--no-deps", "--dest", str(dest), *reqs])
+        except subprocess.CalledProcessError:
+            return []
+
+        files = []
+        for line in output.splitlines():
+            line = line.strip()
+            for prefix in ("Saved ", "File was already downloaded "):
+                if line.startswith(prefix):
+                    files.append(Path(line[len(prefix) :]).resolve())
+        return files
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return {
+            file
+            for files in executor.map(_download, packages.values())
+            for file in files
+        }
+
+
 def install_multiple(
-    env: VirtualEnvironment, packages: List[str], options: Optional[List[str]] = None
+    env: PipEnvironment,
+    packages: Dict[str, List[str]],
+    options: Optional[List[str]] = None,
+    wheel_dir: Optional[Path] = None,
+    lock_file: Optional[Path] = None,
+    download_dir: Optional[Path] = None,
 ):
-    """Install multiple packages into a virtualenvironment at once."""
+    """Install multiple packages into a virtualenvironment at once.
+
+    The packages themselves are first downloaded concurrently, and then installed
+    in a single pip call which fetches any further dependencies. All the requirements
+    on the same package are requested at once, and pip figures out what to actually do.
+
+    If `wheel_dir` is given, the packages are installed offline from the wheels in that
+    directory. Only if that fails are the wheels built (which may need network access)
+    and the install tried again.
+
+    Parameters
+    ----------
+    env
+        The environment to install into.
+    packages
+        The requirement strings to install, grouped by package name as returned by
+        `group_requirements`.
+    options
+        Extra options to pass to pip.
+    wheel_dir
+        An optional directory of wheels to install from.
+    lock_file
+        If given when using uv (and not installing from `wheel_dir`), the full set of
+        requirements is first resolved with `uv pip compile` into this file, which is
+        then installed without further dependency resolution. The installed versions
+        of packages already in the environment are preferred while resolving, so they
+        are only replaced if they must be. This should not be used with system site
+        packages, which uv does not see.
+    download_dir
+        A directory to keep the downloaded packages in, which is also searched for
+        packages to install. Reusing it between installs means packages already
+        downloaded are not fetched again. Anything in it that this install didn't need
+        is removed, so it doesn't build up old versions. If not set a temporary
+        directory is used.
+    """
 
-    # Use a temporary requirements file and then use the usual `env.install`
-    with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tfh:
-        for pkg in packages:
-            tfh.write(f"{pkg}\n")
+    options = list(options or [])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Pipe the requirements to pip through stdin, falling back to a temporary
+        # requirements file where there is no /dev/stdin
+        reqs = "".join(f"{req}\n" for group in packages.values() for req in group)
+        if sys.platform == "win32":
+            reqfile, stdin = Path(tmpdir) / "requirements.txt", None
+            reqfile.write_text(reqs)
+        else:
+            reqfile, stdin = "/dev/stdin", reqs
+        reqfile_args = ["-r", str(reqfile)]
+
+        if wheel_dir is None and lock_file is not None and env.uv is not None:
+            # uv prefers the versions already pinned in the output file, so seed it with
+            # what is installed. Anything that needs a newer version is still upgraded
+            pins = []
+            for name, version in env.installed_versions().items():
+                try:
+                    pins.append(f"{name}=={Version(version)}\n")
+                except InvalidVersion:
+                    pass
+            lock_file.write_text("".join(pins))
+
+            env.compile(reqs, lock_file)
+            env.install(["-r", str(lock_file)], options=options + ["--no-deps"])
+            return
+
+        if wheel_dir is None:
+            # uv already downloads in parallel, so only prefetch when using pip
+            if download_dir is None:
+                download_dir = Path(tmpdir) / "downloads"
+            download_dir.mkdir(parents=True, exist_ok=True)
+            if env.uv is None:
+                files = download_multiple(env, packages, download_dir)
+
+                # Clear out anything left from previous installs
+                for file in download_dir.iterdir():
+                    if file.is_file() and file.resolve() not in files:
+                        file.unlink()
+            env.install(
+                reqfile_args,
+                options=options + ["--find-links", str(download_dir)],
+                input=stdin,
+            )
+            return
+
+        offline_options = options + ["--no-index", "--find-links", str(wheel_dir)]
+        try:
+            env.install(reqfile_args, options=offline_options, input=stdin)
+        except subprocess.CalledProcessError:
+            download_multiple(env, packages, wheel_dir)
+            wheel_args = [*reqfile_args, "--wheel-dir", str(wheel_dir)]
+            env.pip(
+                ["wheel", *wheel_args, "--find-links", str(wheel_dir), *options],
+                input=stdin,
+            )
+            env.install(reqfile_args, options=offline_options, input=stdin)
+
+
+def combine_requirements(
+    repo_requirements: Iterable[Tuple[List[Requirement], List[Requirement]]],
+) -> List[Requirement]:
+    """Combine the runtime and build requirements of several repositories.
+
+    The CHIME packages are built without build isolation, so their build requirements
+    need to be installed along with everything else. These often ask for something
+    quite different to what is needed at runtime (e.g. a pre-release numpy to compile
+    against), so they are only included for packages which aren't already needed at
+    runtime. Older versions of setuptools also need `wheel`, which pip would otherwise
+    add to an isolated build environment itself, so that is always included.
+
+    Parameters
+    ----------
+    repo_requirements
+        The runtime and build requirements of each repository, as returned by
+        `cached_requirements`.
+
+    Returns
+    -------
+    requirements
+        The combined list of requirements.
+    """
+    runtime = []
+    build = []
+    for runtime_requirements, build_requirements in repo_requirements:
+        runtime += runtime_requirements
+        build += build_requirements
+    build.append(Requirement("wheel"))
+
+    runtime_names = {_canonical_name(req.name) for req in runtime}
+    return runtime + [
+        req for req in build if _canonical_name(req.name) not in runtime_names
+    ]
+
+
+def filter_requirements(
+    requirements: List[Requirement],
+    exclude: Iterable[str],
+    installed: Dict[str, str],
+) -> Tuple[List[Requirement], int]:
+    """Remove requirements which don't need to be installed.
+
+    Parameters
+    ----------
+    requirements
+        The requirements to filter.
+    exclude
+        Canonical names of packages to remove, e.g. because they are installed from
+        their own repositories.
+    installed
+        The versions of the installed packages, keyed by canonical name. Requirements
+        already satisfied by these are removed. Requirements with extras or a URL are
+        always kept, as the installed version alone can't tell if they are satisfied.
+
+    Returns
+    -------
+    requirements
+        The remaining requirements.
+    num_excluded
+        How many were removed because they were in `exclude`.
+    """
+    exclude = frozenset(exclude)
+
+    # Apply both filters in a single pass
+    remaining = []
+    num_excluded = 0
+    for req in requirements:
+        name = _canonical_name(req.name)
+        if name in exclude:
+            num_excluded += 1
+            continue
 
-        tfh.flush()
+        if not (req.extras or req.url) and name in installed:
+            try:
+                version = Version(installed[name])
+            except InvalidVersion:
+                # Not a version pip could compare either, so let it decide
+                pass
+            else:
+                if req.specifier.contains(version, prereleases=True):
+                    continue
 
-        env.install(f"-r {tfh.name}", options=options)
+        remaining.append(req)
+
+    return remaining, num_excluded
+
+
+def install_chime_packages(
+    env: PipEnvironment,
+    code_path: Path,
+    names: List[str],
+    compat: bool,
+    progress: Progress,
+) -> Dict[str, str]:
+    """Make editable installs of the CHIME packages.
+
+    Don't try to resolve any dependencies, these should already have been installed
+    and so we can install all the CHIME packages. As the installs are then independent,
+    and dominated by the time taken to build each package, they are run concurrently.
+
+    NOTE: this could in theory break if they have *build* time dependencies on one
+    another
+
+    Parameters
+    ----------
+    env
+        The environment to install into.
+    code_path
+        The directory the repositories are checked out in.
+    names
+        The names of the repositories to install.
+    compat
+        Use the legacy editable install mode.
+    progress
+        The Progress instance to show the installs in.
+
+    Returns
+    -------
+    failures
+        The error output for each package that failed to install.
+    """
+    options = ["--no-deps", "--no-build-isolation"]
+    if compat:
+        options += ["--config-settings", "editable_mode=compat"]
+
+    failures = {}
+
+    # Each install runs in its own pip process, so threads are enough to build them
+    # in parallel across the available cores
+    install_workers = min(os.cpu_count() or 1, len(names))
+    with ThreadPoolExecutor(max_workers=install_workers) as executor:
+        futures = {}
+        for label, name in labeller(names):
+            task = progress.add_task(f"{label} {name}", total=None)
+
+            future = executor.submit(
+                env.install, ["-e", str(code_path / name)], options=options
+            )
+            futures[future] = (name, task)
+
+        for future in as_completed(futures):
+            name, task = futures[future]
+            try:
+                future.result()
+            except subprocess.CalledProcessError as e:
+                failures[name] = e.stderr
+            progress.reset(task, total=1, completed=1)
+
+    return failures
 
 
 @cli.command()
@@ -238,7 +1170,11 @@ def install_multiple(
 @click.option(
     "--ignore-system-packages/--use-system-packages",
     show_default=True,
-    help="Whether to ignore system site packages when creating the virtualen v.",
+    help=(
+        "Whether to ignore system site packages when creating the virtualenv. Using "
+        "them reuses an existing scientific stack (e.g. the cedar modules) rather than "
+        "installing it again."
+    ),
 )
 @click.option(
     "--chime-member/--non-chime-member",
@@ -246,6 +1182,65 @@ def install_multiple(
     default=True,
     help="Whether to include private CHIME repositories.",
 )
+@click.option(
+    "--shallow/--full",
+    " /--full-history",
+    show_default=True,
+    default=False,
+    help=(
+        "Whether to only clone the latest commit of each repository. By default a "
+        "partial clone is made, which has the full history but only downloads old "
+        "files when needed. Shallow clones lack the tags the packages take their "
+        "versions from."
+    ),
+)
+@click.option(
+    "--wheel-dir",
+    default=None,
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+    help=(
+        "Directory of wheels to install dependencies from. Any missing wheels are "
+        "built into it, so it can be reused to create environments offline."
+    ),
+)
+@click.option(
+    "--backend",
+    show_default=True,
+    default="pip",
+    type=click.Choice(["pip", "uv"]),
+    help="The tool used to install packages. Falls back to pip if uv is not found.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    show_default=True,
+    default=8,
+    type=click.IntRange(min=1),
+    help="The maximum number of repositories to clone at once.",
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+    help=(
+        "Directory for the package caches. Defaults to pip's and uv's own caches, with "
+        "prefetched packages kept in the user cache directory. Pointing this at a fast "
+        "local filesystem speeds up installs."
+    ),
+)
+@click.option(
+    "--upgrade-pip/--no-upgrade-pip",
+    show_default=True,
+    help=(
+        "Whether to upgrade pip in the environment to the latest version. It is always "
+        f"upgraded if older than {MIN_PIP_VERSION}."
+    ),
+)
+@click.option(
+    "--refresh-requirements",
+    is_flag=True,
+    help="Parse the requirements of every repository again, ignoring the cache.",
+)
 def create(
     path: Path,
     prompt: str,
@@ -254,6 +1249,13 @@ def create(
     download: bool,
     ignore_system_packages: bool,
     chime_member: bool,
+    shallow: bool,
+    wheel_dir: Optional[Path],
+    backend: str,
+    jobs: int,
+    cache_dir: Optional[Path],
+    upgrade_pip: bool,
+    refresh_requirements: bool,
 ):
     """Install a CHIME pipeline environment at the specified PATH.
 
@@ -277,20 +1279,42 @@ def create(
 
     venv_path = path / "venv"
 
-    if venv_path.exists():
+    create_venv = not venv_path.exists()
+    if not create_venv:
         console.print(
             f"Virtual environment already exists at {venv_path}. Using it anyway."
         )
-    else:
-        venv.create(
-            venv_path,
-            system_site_packages=not ignore_system_packages,
-            with_pip=True,
-            prompt=prompt,
-        )
-    env = VirtualEnvironment(str(venv_path))
-    console.print("Upgrading pip")
-    env.upgrade("pip")
+
+    uv = None
+    if backend == "uv":
+        uv = find_uv()
+        if uv is None:
+            console.print("Could not find uv. Using pip instead.")
+    env = PipEnvironment(venv_path, uv=uv)
+
+    cache_base = use_cache_dir(env, cache_dir)
+    if cache_dir is not None:
+        console.print(f"Using package caches in {cache_dir}")
+
+    def _setup_env():
+        if create_venv:
+            # Symlink to the base interpreter rather than copying it, except on Windows
+            # where that is not reliable
+            builder = venv.EnvBuilder(
+                system_site_packages=not ignore_system_packages,
+                symlinks=(os.name != "nt"),
+                with_pip=True,
+                prompt=prompt,
+            )
+            builder.create(venv_path)
+        pip_version = env.pip_version()
+        if upgrade_pip or pip_version < MIN_PIP_VERSION:
+            console.print(f"Upgrading pip from version {pip_version}")
+            env.upgrade("pip")
+        else:
+            console.print(f"Using existing pip version {pip_version}")
+        # Cache the list of installed packages now rather than waiting for the clones
+        env.installed_versions()
 
     # Determine which repositories to close
     if chime_member:
@@ -298,111 +1322,140 @@ def create(
     else:
         chime_repositories = public_repositories(ssh=False)
 
-    # Clone the CHIME repos and extract their dependencies
-    console.rule("Cloning CHIME repositories")
-
-    code_path = path / "code"
-    code_path.mkdir()
-
-    requirements = []
-
+    # Use a single progress display for all the phases, rather than setting up a new one
+    # each time
     with Progress(
         *Progress.get_default_columns()[:-1],
         console=console,
+        transient=False,
+        refresh_per_second=10,
     ) as progress:
-        for label, (name, (url, target)) in labeller(chime_repositories.items()):
-            clone_path = code_path / name
-
-            git.Repo.clone_from(
-                url,
-                branch=target,
-                to_path=clone_path,
-                progress=RichProgress(f"{label} {name}", progress),
-            )
-
-            requirements += find_requirements(clone_path)
-
-    console.rule("Analyzing dependencies...")
-    console.print(f"{len(requirements)} total dependencies.")
-
-    # Remove the specified CHIME packages from the install list
-    chime_repo_names = list(chime_repositories.keys())
-    requirements = [
-        req
-        for req in requirements
-        if req.name.replace(".", "-") not in chime_repo_names
-    ]
-    console.print(f"{len(requirements)} after removing CHIME pipeline packages.")
+        # Clone the CHIME repos and extract their dependencies
+        console.rule("Cloning CHIME repositories")
+
+        code_path = path / "code"
+        code_path.mkdir()
+
+        repo_requirements = {}
+
+        # Setting up the environment doesn't depend on the CHIME repositories, so do
+        # it alongside the clones. It runs on its own thread so that it never takes the
+        # place of a clone
+        env_executor = ThreadPoolExecutor(max_workers=1)
+        env_future = env_executor.submit(_setup_env)
+        env_executor.shutdown(wait=False)
+
+        with ThreadPoolExecutor(
+            max_workers=min(jobs, len(chime_repositories))
+        ) as executor:
+            # Cloning is network bound, so run the clones concurrently
+            futures = {}
+            for label, (name, (url, target)) in labeller(chime_repositories.items()):
+                clone_path = code_path / name
+
+                future = executor.submit(
+                    clone_repository,
+                    url,
+                    clone_path,
+                    branch=target,
+                    shallow=shallow,
+                    label=f"{label} {name}",
+                    progress=progress,
+                )
+                futures[future] = (name, clone_path)
+
+            # As each clone finishes, parse its project file in the pool alongside the
+            # remaining clones
+            for future in as_completed(futures):
+                name, clone_path = futures[future]
+                sha = future.result()
+                repo_requirements[name] = executor.submit(
+                    cached_requirements,
+                    name,
+                    clone_path,
+                    sha,
+                    refresh=refresh_requirements,
+                )
+
+            env_future.result()
+
+        # Gather the requirements in a fixed order regardless of when each clone
+        # finished
+        requirements = combine_requirements(
+            repo_requirements[name].result() for name in chime_repositories
+        )
 
-    # Also filter out packages that are already installed
-    # NOTE: this uses a private method from virtualenv-api so may be fragile
-    installed_packages = [
-        p.split("==")[0] for p in env._execute_pip(["freeze"]).splitlines()
-    ]
-    requirements = [req for req in requirements if str(req) not in installed_packages]
-    console.print(f"{len(requirements)} after removing already installed packages.")
+        console.rule("Analyzing dependencies...")
+        console.print(f"{len(requirements)} total dependencies.")
 
-    # Add the extras to make up for problems parsing
-    requirements += [Requirement(req) for req in extra_packages]
-    console.print(f"{len(requirements)} after adding manual extras.")
+        # Remove the specified CHIME packages from the install list, and also any
+        # packages that are already installed at a suitable version
+        chime_repo_names = list(chime_repositories.keys())
+        chime_canon = frozenset(_canonical_name(name) for name in chime_repo_names)
+        installed_packages = env.installed_versions()
 
-    # Group packages together by name to prevent repeated install attempts
-    req_dict = {}
-    for req in requirements:
-        name = canonicalize_name(req.name)
-        if name not in req_dict:
-            req_dict[name] = []
-        req_dict[name].append(req)
-    console.print(f"{len(req_dict)} after removing dupes.")
+        num_total = len(requirements)
+        requirements, num_chime = filter_requirements(
+            requirements, chime_canon, installed_packages
+        )
+        console.print(
+            f"{num_total - num_chime} after removing CHIME pipeline packages."
+        )
+        console.print(f"{len(requirements)} after removing already installed packages.")
 
-    # Go through and install all the remaining packages into the virtualenv
-    console.rule("Installing remaining dependencies")
+        # Add the extras to make up for problems parsing
+        requirements += [Requirement(req) for req in extra_packages]
+        console.print(f"{len(requirements)} after adding manual extras.")
 
-    with Progress(
-        *Progress.get_default_columns()[:-1],
-        console=console,
-    ) as progress:
-        for label, (reqname, reqs) in labeller(req_dict.items()):
-            task = progress.add_task(f"{label} {reqname}", total=None)
-
-            # Request all versions of the same package be installed at once and let pip
-            # figure out what to actually do
-            req_strs = [str(req) for req in reqs]
-            options = ["--no-build-isolation"] if fast else None
-            install_multiple(env, list(set(req_strs)), options=options)
-            progress.reset(task, total=1, completed=1)
+        # Group packages together by name to prevent repeated install attempts
+        try:
+            req_dict = group_requirements(requirements)
+        except ValueError as e:
+            console.print(str(e))
+            sys.exit(1)
+        console.print(f"{len(req_dict)} after removing dupes.")
+
+        # Go through and install all the remaining packages into the virtualenv
+        console.rule("Installing remaining dependencies")
+
+        # Request all the packages be installed in a single pip call. This avoids the
+        # overhead of starting pip for each package, and lets pip resolve everything
+        # together
+        task = progress.add_task(f"{len(req_dict)} packages", total=None)
+
+        options = ["--no-build-isolation"] if fast else None
+
+        # uv can't see the system site packages when resolving, so only make a lock
+        # file when they are ignored. Otherwise they would all be installed again
+        lock_file = code_path / "requirements.txt" if ignore_system_packages else None
+
+        install_multiple(
+            env,
+            req_dict,
+            options=options,
+            wheel_dir=wheel_dir,
+            lock_file=lock_file,
+            download_dir=cache_base / "packages",
+        )
+        progress.reset(task, total=1, completed=1)
 
-    console.rule("Installing CHIME packages")
+        console.rule("Installing CHIME packages")
 
-    # Install the CHIME packages in editable mode. Don't try to resolve any
-    # dependencies, this should have been done above and so we can install all the CHIME
-    # packages.
-    # NOTE: this could in theory break if they have *build* time dependencies on one
-    # another and they are installed in the wrong order
-    with Progress(
-        *Progress.get_default_columns()[:-1],
-        console=console,
-    ) as progress:
-        for label, chime_package in labeller(chime_repo_names):
-            task = progress.add_task(
-                f"{label} {chime_package}",
-                total=None,
-            )
+        # Install the CHIME packages in editable mode
+        failures = install_chime_packages(
+            env, code_path, chime_repo_names, compat, progress
+        )
 
-            options = ["--no-deps"]
-            if fast:
-                options += ["--no-build-isolation"]
-            if compat:
-                options += ["--config-settings", "editable_mode=compat"]
-            env.install(f"-e {code_path / chime_package}", options=options)
-            progress.reset(task, total=1, completed=1)
+    if failures:
+        for chime_package, error in failures.items():
+            console.print(f"Failed to install {chime_package}. Error: {error}")
+        sys.exit(1)
 
     if download:
         console.rule("Downloading skyfield ephemeris data")
         try:
-            env._execute(
+            env.python(
                 [
-                    env._python_rpath,
                     "-c",
                     "from caput.time import skyfield_wrapper as s; s.timescale; s.ephemeris",
                 ]
@@ -413,9 +1466,149 @@ def create(
 
 @cli.command()
 @click.argument("path", type=click.Path(resolve_path=True, path_type=Path))
-def update(path):
-    """Update all the packages in the virtualenvironment at PATH.
+@click.option(
+    "--compat/--no-compat",
+    show_default=True,
+    help="Whether to use legacy editable install mode.",
+)
+@click.option(
+    "--backend",
+    show_default=True,
+    default="pip",
+    type=click.Choice(["pip", "uv"]),
+    help="The tool used to install packages. Falls back to pip if uv is not found.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    show_default=True,
+    default=8,
+    type=click.IntRange(min=1),
+    help="The maximum number of repositories to update at once.",
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+    help=(
+        "Directory for the package caches. Use the same directory as when the "
+        "environment was created."
+    ),
+)
+def update(
+    path: Path, compat: bool, backend: str, jobs: int, cache_dir: Optional[Path]
+):
+    """Update the CHIME pipeline environment at PATH.
+
+    This pulls the latest changes into each of the CHIME repositories. Only the
+    repositories that changed are processed further: any new or unsatisfied
+    dependencies they have are installed, and the packages themselves are reinstalled
+    so that their metadata and any compiled extensions are rebuilt.
 
-    Not yet implemented.
+    Repositories with changes that can't be fast-forwarded are left alone and
+    reported. Note that repositories created with `--shallow` will need a
+    `git fetch --unshallow` before their full history is available.
     """
-    pass
+
+    console = Console()
+
+    venv_path = path / "venv"
+    code_path = path / "code"
+    if not venv_path.is_dir() or not code_path.is_dir():
+        console.print(f"No CHIME environment found at {str(path)}.")
+        sys.exit(1)
+
+    repo_names = sorted(
+        repo.name for repo in code_path.iterdir() if (repo / ".git").exists()
+    )
+    if not repo_names:
+        console.print(f"No repositories found in {str(code_path)}.")
+        sys.exit(1)
+
+    uv = None
+    if backend == "uv":
+        uv = find_uv()
+        if uv is None:
+            console.print("Could not find uv. Using pip instead.")
+    env = PipEnvironment(venv_path, uv=uv)
+    cache_base = use_cache_dir(env, cache_dir)
+
+    pull_failures = {}
+    install_failures = {}
+
+    with Progress(
+        *Progress.get_default_columns()[:-1],
+        console=console,
+        transient=False,
+        refresh_per_second=10,
+    ) as progress:
+        console.rule("Updating CHIME repositories")
+
+        # Pull all the repositories concurrently, and as each one finishes parse the
+        # requirements of those that have changed
+        repo_requirements = {}
+        with ThreadPoolExecutor(max_workers=min(jobs, len(repo_names))) as executor:
+            futures = {}
+            for label, name in labeller(repo_names):
+                future = executor.submit(
+                    pull_repository, code_path / name, f"{label} {name}", progress
+                )
+                futures[future] = name
+
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    old_sha, new_sha = future.result()
+                except git.GitCommandError as e:
+                    pull_failures[name] = e.stderr
+                    continue
+
+                if old_sha != new_sha:
+                    repo_requirements[name] = executor.submit(
+                        cached_requirements, name, code_path / name, new_sha
+                    )
+
+        changed = [name for name in repo_names if name in repo_requirements]
+
+        if not changed:
+            console.print("None of the CHIME repositories have changed.")
+        else:
+            console.print(f"Updated {', '.join(changed)}.")
+
+            console.rule("Installing new dependencies")
+
+            requirements = combine_requirements(
+                repo_requirements[name].result() for name in changed
+            )
+
+            # Only install what the environment doesn't already satisfy
+            requirements, _ = filter_requirements(
+                requirements,
+                [_canonical_name(name) for name in repo_names],
+                env.installed_versions(),
+            )
+
+            if requirements:
+                try:
+                    req_dict = group_requirements(requirements)
+                except ValueError as e:
+                    console.print(str(e))
+                    sys.exit(1)
+
+                task = progress.add_task(f"{len(req_dict)} packages", total=None)
+                install_multiple(env, req_dict, download_dir=cache_base / "packages")
+                progress.reset(task, total=1, completed=1)
+            else:
+                console.print("No new dependencies to install.")
+
+            console.rule("Reinstalling CHIME packages")
+            install_failures = install_chime_packages(
+                env, code_path, changed, compat, progress
+            )
+
+    for name, error in pull_failures.items():
+        console.print(f"Failed to update {name}. Error: {error}")
+    for name, error in install_failures.items():
+        console.print(f"Failed to install {name}. Error: {error}")
+    if pull_failures or install_failures:
+        sys.exit(1)